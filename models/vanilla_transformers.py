@@ -4,7 +4,6 @@ import torch.nn.functional as F
 import math
 
 from torch import Tensor
-from einops import rearrange
 
 class FFN(nn.Module):
     def __init__(self, input_size:int, hidden_size:int, output_size:int, num_layers:int, ffn_pdrop:float):
@@ -35,7 +34,7 @@ class MultiHeadAttention(nn.Module):
         # output projection
         self.c_proj = nn.Linear(num_attention_heads*emb_dim, emb_dim)
         # regularization
-        self.attn_dropout = nn.Dropout(attn_pdrop)
+        self.attn_pdrop = attn_pdrop
         self.linear_proj_dropout = nn.Dropout(linear_proj_pdrop)        
         self.n_head = num_attention_heads
         self.n_embd = emb_dim
@@ -44,16 +43,12 @@ class MultiHeadAttention(nn.Module):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        q, k ,v  = self.c_attn(x).split(self.n_head*self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C ).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C ).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C ).transpose(1, 2) # (B, nh, T, hs)
-
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_dropout(att)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        qkv = self.c_attn(x).view(B, T, 3, self.n_head, C).permute(2, 0, 3, 1, 4) # (3, B, nh, T, hs)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        # self-attention with a fused kernel (FlashAttention / memory-efficient when available)
+        # (B, nh, T, hs) x (B, nh, hs, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        y = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_pdrop if self.training else 0.0)
         y = y.transpose(1, 2).contiguous().view(B, T, self.n_head*C) # re-assemble all head outputs side by side
 
         # output projection
@@ -94,9 +89,7 @@ class Encoder(nn.Module):
                                    linear_proj_pdrop=linear_proj_pdrop))
     def forward(self, x:Tensor):
         x = self.emb_drop(self.embedding(x))
-        x = rearrange(x, 'b s e -> s b e') # rearrange to fit positional encoding
         x = self.pos_encoding(x)
-        x = rearrange(x, 's b e -> b s e')
         x = self.encoder(x)
         return x
 
@@ -107,18 +100,29 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(p=pos_emb_pdrop)
         position = torch.arange(max_seq_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, emb_dim, 2) * (-math.log(10000.0) / emb_dim))
-        pe = torch.zeros(max_seq_len, 1, emb_dim)
-        pe[:, 0, 0::2] = torch.sin(position * div_term)
-        pe[:, 0, 1::2] = torch.cos(position * div_term)
-        self.register_buffer('pe', pe)
+        pe = torch.zeros(max_seq_len, emb_dim)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        self.register_buffer('pe', pe, persistent=False)
 
     def forward(self, x: Tensor) -> Tensor:
         """
         Arguments:
-            x: Tensor, shape ``[seq_len, batch_size, embedding_dim]``
+            x: Tensor, shape ``[batch_size, seq_len, embedding_dim]``
         """
-        x = x + self.pe[:x.size(0)]
+        x = x + self.pe[:x.size(-2)]
         return self.dropout(x)
 
 
-
+def quantize_ffn(model: nn.Module) -> nn.Module:
+    """
+    Post-training INT8 dynamic quantization of the FFN linears of every EncoderBlock in ``model``
+    (in place). Attention stays in floating point, and the quantized linears return float tensors,
+    so the following LayerNorm is unaffected. Dynamic quantization runs on CPU only, for inference.
+    Pass the uncompiled model: a ``torch.compile`` wrapper keeps running its cached graph and
+    would not pick up the swapped modules.
+    """
+    for module in model.modules():
+        if isinstance(module, EncoderBlock):
+            module.ffn = torch.ao.quantization.quantize_dynamic(module.ffn, {nn.Linear}, dtype=torch.qint8)
+    return model
@@ -4,7 +4,8 @@ from models.vanilla_transformers import (
                    FFN, 
                    Encoder, 
                    MultiHeadAttention,
-                   PositionalEncoding)
+                   PositionalEncoding,
+                   quantize_ffn)
 from models.BERT import BERT
 
 def test_ffn():
@@ -36,6 +37,22 @@ def test_encoder_block():
     z = single_encoder_block(x)
     assert z.shape == (3, 2, 200)
 
+def test_quantize_ffn():
+    emb_dim, num_attention_heads = 200, 2
+    hidden_size, num_layers, ffn_pdrop = 20, 4, 0.2
+    attn_pdrop, linear_proj_pdrop = 0.2, 0.2
+    x = torch.randn(3, 2, 200)
+    single_encoder_block = EncoderBlock(emb_dim=emb_dim, num_attention_heads=num_attention_heads, 
+                                   hidden_size=hidden_size, num_layers=num_layers, 
+                                   ffn_pdrop=ffn_pdrop, attn_pdrop=attn_pdrop, 
+                                   linear_proj_pdrop=linear_proj_pdrop).eval()
+    quantize_ffn(single_encoder_block)
+    assert isinstance(single_encoder_block.multi_head_attention.c_attn, torch.nn.Linear)
+    assert not any(isinstance(m, torch.nn.Linear) for m in single_encoder_block.ffn.modules())
+    z = single_encoder_block(x)
+    assert z.shape == (3, 2, 200)
+    assert z.dtype == torch.float32
+
 def test_encoder():
     emb_dim, num_attention_heads = 200, 2
     hidden_size, num_layers, ffn_pdrop = 20, 4, 0.2
@@ -59,4 +76,9 @@ def test_postional_encoding():
     x = torch.randn(3, 2, 10)
     pos_encoding = PositionalEncoding(10, pos_emb_pdrop, max_seq_len)
     z = pos_encoding(x)
-    assert z.shape == (3, 2, 10)
\ No newline at end of file
+    assert z.shape == (3, 2, 10)
+
+    # batch-first: every batch row gets the same encoding for its positions
+    pos_encoding = PositionalEncoding(10, 0., max_seq_len)
+    z = pos_encoding(x)
+    assert torch.allclose(z, x + pos_encoding.pe[:x.size(1)])
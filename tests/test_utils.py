@@ -1,5 +1,8 @@
+import torch
 from utils import getMask
 
 def test_getMask():
     mask = getMask(seq_len=4)
-    assert mask.shape == (4, 4)
\ No newline at end of file
+    assert mask.shape == (4, 4)
+    assert mask.dtype == torch.bool
+    assert torch.equal(mask, torch.tensor([[i <= j for j in range(4)] for i in range(4)]))
@@ -1,9 +1,13 @@
 from models.BERT import BERT
+from models.vanilla_transformers import quantize_ffn
 import math
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
+from contextlib import nullcontext
 import hydra
 import wandb
 import datetime
+import copy
+from array import array
 
 import torch
 from torch import nn, Tensor
@@ -13,8 +17,6 @@ from torchtext.datasets import WikiText2
 from torchtext.data.utils import get_tokenizer
 from torchtext.vocab import build_vocab_from_iterator
 
-from einops import rearrange
-
 import time
 
 # *** Train BERT on wikitext-2 dataset ***
@@ -23,8 +25,10 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 def data_process(raw_text_iter: IterableDataset, vocab, tokenizer) -> Tensor:
     """Converts raw text into a flat Tensor."""
-    data = [torch.tensor(vocab(tokenizer(item)), dtype=torch.long) for item in raw_text_iter]
-    return torch.cat(tuple(filter(lambda t: t.numel() > 0, data)))
+    flat_ids = array('i') # int32, grows in place instead of allocating a tensor per line
+    for item in raw_text_iter:
+        flat_ids.extend(vocab(tokenizer(item)))
+    return torch.frombuffer(flat_ids, dtype=torch.int32).clone()
 
 def batchify(data: Tensor, bsz: int) -> Tensor:
     """Divides the data into ``bsz`` separate sequences, removing extra elements
@@ -35,69 +39,79 @@ def batchify(data: Tensor, bsz: int) -> Tensor:
         bsz: int, batch size
 
     Returns:
-        Tensor of shape ``[N // bsz, bsz]``
+        Tensor of shape ``[bsz, N // bsz]``
     """
     seq_len = data.size(0) // bsz
     data = data[:seq_len * bsz]
-    data = data.view(bsz, seq_len).t().contiguous()
-    return data.to(device)
+    data = data.view(bsz, seq_len)
+    if device.type == 'cuda':
+        # page-locked memory lets the one-off upload run as an async DMA copy
+        data = data.pin_memory()
+    return data.to(device, non_blocking=True)
 
 def get_batch(source: Tensor, i: int, sq_len: int) -> Tuple[Tensor, Tensor]:
     """
     Args:
-        source: Tensor, shape ``[full_seq_len, batch_size]``
+        source: Tensor, shape ``[batch_size, full_seq_len]``
         i: int
 
     Returns:
-        tuple (data, target), where data has shape ``[seq_len, batch_size]`` and
-        target has shape ``[seq_len * batch_size]``
+        tuple (data, target), where data has shape ``[batch_size, seq_len]`` and
+        target has shape ``[batch_size * seq_len]``
     """
-    sq_len = min(sq_len, len(source) - 1 - i)
-    data = source[i:i+sq_len]
-    target = rearrange(source[i+1:i+1+sq_len], 'seq batch -> batch seq').reshape(-1)
+    sq_len = min(sq_len, source.size(1) - 1 - i)
+    data = source[:, i:i+sq_len]
+    target = source[:, i+1:i+1+sq_len].reshape(-1).long() # CrossEntropyLoss expects int64 targets
     return data, target
 
 def train(model: nn.Module, train_data: Tensor, val_data: Tensor, 
           num_epochs:int, criterion, lr:Union[float, int], 
           optimizer, scheduler, ntokens:int, sq_len:int,
-          log_interval: int, wandb_enabled: bool) -> None:
+          log_interval: int, wandb_enabled: bool,
+          amp_dtype: Optional[torch.dtype] = None, drop_last: bool = False) -> None:
     for epoch in range(1, num_epochs + 1):
         epoch_start_time = time.time()
         model.train()  # turn on train mode
-        total_loss = 0.
+        total_loss = torch.zeros((), device=device) # accumulate on device to avoid a sync every step
         log_interval = log_interval
         start_time = time.time()
 
-        num_batches = len(train_data) // sq_len
-        for batch, i in enumerate(range(0, train_data.size(0) - 1, sq_len)):
+        num_batches = train_data.size(1) // sq_len
+        # ``drop_last`` skips the shorter tail batch so a compiled model sees a single input shape,
+        # unless no full batch fits, in which case the tail is the only batch
+        stop = train_data.size(1) - sq_len if drop_last and train_data.size(1) > sq_len else train_data.size(1) - 1
+        for batch, i in enumerate(range(0, stop, sq_len)):
             data, targets = get_batch(train_data, i, sq_len)
-            data = rearrange(data, 'seq batch -> batch seq')
-            output = model(data)
-            output_flat = output.view(-1, ntokens)
-            loss = criterion(output_flat, targets)
+            optimizer.zero_grad(set_to_none=True)
+            # autocast runs the matmuls in ``amp_dtype`` on tensor cores; weights, grads and
+            # optimizer state stay in fp32. ``amp_dtype=None`` trains in plain fp32
+            autocast = torch.autocast(device_type=device.type, dtype=amp_dtype) if amp_dtype is not None else nullcontext()
+            with autocast:
+                output = model(data)
+                output_flat = output.view(-1, ntokens)
+                loss = criterion(output_flat, targets)
 
-            optimizer.zero_grad()
             loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5, foreach=True)
             optimizer.step()
 
-            total_loss += loss.item()
+            total_loss += loss.detach()
             if batch % log_interval == 0 and batch > 0:
                 lr = scheduler.get_last_lr()[0]
                 ms_per_batch = (time.time() - start_time) * 1000 / log_interval
-                cur_loss = total_loss / log_interval
+                cur_loss = (total_loss / log_interval).item()
                 ppl = math.exp(cur_loss)
                 print(f'| epoch {epoch:3d} | {batch:5d}/{num_batches:5d} batches | '
                     f'lr {lr:02.2f} | ms/batch {ms_per_batch:5.2f} | '
                     f'loss {cur_loss:5.2f} | ppl {ppl:8.2f}')
-                total_loss = 0
+                total_loss.zero_()
                 start_time = time.time()
                 if wandb_enabled: 
                     wandb.log({"loss": cur_loss}, step = batch + (epoch-1)*num_batches)
             
                 
             
-        val_loss = evaluate(model, val_data,criterion,sq_len,ntokens)
+        val_loss = evaluate(model, val_data,criterion,sq_len,ntokens, drop_last=drop_last)
         val_ppl = math.exp(val_loss)
         
         if wandb_enabled:
@@ -111,22 +125,32 @@ def train(model: nn.Module, train_data: Tensor, val_data: Tensor,
         print('-' * 89)
         scheduler.step()
 
-def evaluate(model: nn.Module, eval_data: Tensor, criterion, sq_len:int, ntokens:int,) -> float:
+def evaluate(model: nn.Module, eval_data: Tensor, criterion, sq_len:int, ntokens:int,
+             drop_last: bool = False) -> float:
     model.eval()  # turn on evaluation mode
-    total_loss = 0.
+    total_loss = torch.zeros((), device=eval_data.device)
+    total_len = 0
+    stop = eval_data.size(1) - sq_len if drop_last and eval_data.size(1) > sq_len else eval_data.size(1) - 1
     with torch.no_grad():
-        for i in range(0, eval_data.size(0) - 1, sq_len):
+        for i in range(0, stop, sq_len):
             data, targets = get_batch(eval_data, i, sq_len)
-            data = rearrange(data, 'seq batch -> batch seq')
-            seq_len = data.size(0)
+            seq_len = data.size(1)
             output = model(data)
             output_flat = output.view(-1, ntokens)
-            total_loss += seq_len*criterion(output_flat, targets).item()
-    return total_loss / (len(eval_data) - 1)
+            total_loss += seq_len*criterion(output_flat, targets)
+            total_len += seq_len
+    return total_loss.item() / total_len
 
 
 @hydra.main(version_base=None, config_path="conf", config_name="BERT")
 def main(cfg) -> None:
+    # Allow TF32 tensor cores for the fp32 matmuls/convolutions left outside autocast
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # bf16 autocast needs compute capability >= 8.0 (A100/H100). It keeps fp32's exponent range,
+    # so no GradScaler is needed; older GPUs and CPU train in fp32
+    amp_dtype = torch.bfloat16 if device.type == 'cuda' and torch.cuda.is_bf16_supported() else None
+
     # Prepare data
     train_iter = WikiText2(split='train')
     tokenizer = get_tokenizer('basic_english')
@@ -141,7 +165,7 @@ def main(cfg) -> None:
     test_data = data_process(test_iter, vocab, tokenizer)
     
     ntokens = len(vocab)  # size of vocabulary
-    train_data = batchify(train_data, cfg.training.train_batch_size)  # shape ``[seq_len, batch_size]``
+    train_data = batchify(train_data, cfg.training.train_batch_size)  # shape ``[batch_size, seq_len]``
     val_data = batchify(val_data, cfg.training.eval_batch_size)
     test_data = batchify(test_data, cfg.training.eval_batch_size)
     
@@ -160,11 +184,16 @@ def main(cfg) -> None:
                 max_seq_len=cfg.model.max_seq_len,
                 num_encoder_blocks=cfg.model.num_encoder_blocks)
     model = model.to(device)
+    bert = model # uncompiled handle, e.g. for post-training quantization
+    # Fuse the model into Inductor kernels; disable with ``training.compile=False`` when debugging
+    compiled = cfg.training.compile and hasattr(torch, 'compile')
+    if compiled:
+        model = torch.compile(model, mode='max-autotune')
 
     criterion = nn.CrossEntropyLoss()
 
      # The number of epochs
-    optimizer = torch.optim.SGD(model.parameters(), lr=cfg.training.lr)
+    optimizer = torch.optim.SGD(model.parameters(), lr=cfg.training.lr, foreach=True)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 1.0, gamma=0.95)
 
     #Add wandb for logging training loss and validation loss
@@ -183,7 +212,14 @@ def main(cfg) -> None:
                         criterion=criterion, 
                         log_freq=cfg.wandb.log_freq, 
                         log_graph=True)
-    
+
+    # Only allow the fused attention kernels so shapes/dtypes they can't handle fail loudly
+    # instead of silently falling back to the math kernel
+    if cfg.training.force_flash_attention and device.type == 'cuda':
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        torch.backends.cuda.enable_math_sdp(False)
+
     train(model=model,
           train_data=train_data,
           val_data=val_data,
@@ -195,7 +231,21 @@ def main(cfg) -> None:
           ntokens=ntokens, 
           sq_len=cfg.training.sq_len ,
           log_interval=cfg.training.log_interval,
-          wandb_enabled=cfg.wandb.is_enabled)
+          wandb_enabled=cfg.wandb.is_enabled,
+          amp_dtype=amp_dtype,
+          drop_last=compiled)
+
+    # Evaluate the test set with INT8 FFN linears; dynamic quantization only runs on CPU
+    if cfg.training.quantized_test:
+        quantized_model = quantize_ffn(copy.deepcopy(bert).cpu())
+        test_loss = evaluate(quantized_model, test_data.cpu(), criterion, cfg.training.sq_len, ntokens)
+        test_ppl = math.exp(test_loss)
+        if cfg.wandb.is_enabled:
+            wandb.log({"quantized_test_loss": test_loss, "quantized_test_ppl": test_ppl})
+        print('=' * 89)
+        print(f'| End of training | quantized test loss {test_loss:5.2f} | '
+            f'quantized test ppl {test_ppl:8.2f}')
+        print('=' * 89)
 
 
 if __name__ == "__main__":